@@ -2,17 +2,29 @@ from datetime import datetime
 from dateutil import parser
 import json
 import logging
+from mapping import CompiledMapping, load_projected
+from serializer import TurtleSerializer
 
 
 logger = logging.getLogger()
 
+GML_POS_ORI = "http://www.opengis.net/gml/pos"
+
+
 def default_custom_function(id):
     return id
 
+
 class JsonToRDFConverter:
 
-    def __init__(self, mapping, default_custom_function=None, separator='.'):
+    def __init__(self, mapping, default_custom_function=None, separator='.', serializer=None, compiled_mapping=None):
         self.mapping = mapping
+        # Lookup indexes of the mapping, a compiled mapping can be shared by several converters of the same mapping
+        if compiled_mapping is not None and compiled_mapping.mapping is not mapping:
+            raise Exception("The compiled mapping was built from another mapping object, it can only be shared by "
+                            "converters given the very same mapping object.")
+        self.compiled_mapping = compiled_mapping if compiled_mapping is not None else CompiledMapping(mapping,
+                                                                                                      separator)
         self.switchDict = {
             "boolean": self.boolean,
             "integer": self.integer,
@@ -26,6 +38,8 @@ class JsonToRDFConverter:
         # Big map of <String, Dict>, for each individual is stored with the ori as its key, and the data as the value.
         self.map_items = dict()
         self.custom_function = default_custom_function
+        # Renders the individuals, the same serializer must be given to the DataManager injecting them
+        self.serializer = serializer if serializer is not None else TurtleSerializer()
 
     def parse(self, data):
 
@@ -47,6 +61,12 @@ class JsonToRDFConverter:
 
         return self.map_items
 
+    def parse_stream(self, stream, streaming=False):
+        # Parse a JSON payload from a binary stream, the fields the mapping never reads are dropped while loading.
+        # streaming trades speed for memory : it is slower but the dropped fields are never loaded, use it for
+        # payloads which do not fit in memory (requires ijson).
+        return self.parse(load_projected(stream, self.compiled_mapping.projection, streaming))
+
     def loop_through_data(self, map_items, skeleton, json_data):
 
         if json_data is None:
@@ -151,7 +171,8 @@ class JsonToRDFConverter:
 
     def process_turtle(self, mapping, individual_ori, individual_data):
 
-        ttl = ""
+        # List of the (predicate, object) rendered terms of the individual
+        statements = []
 
         # Metadata
         class_metadata = mapping["_class"]
@@ -162,28 +183,21 @@ class JsonToRDFConverter:
 
             class_field = class_metadata["field"]
             field_value = individual_data[class_field]
-            field_value_to_owl_class_map = class_metadata["map"]
 
-            if field_value in field_value_to_owl_class_map:
-                ttl += self.declare_new_individual(individual_ori, field_value_to_owl_class_map[field_value])
-            else:
-                raise BaseException(
-                    "Could not find appropriate class for following individual : {}"
-                    " with class field {} and value {}".format(individual_ori, class_field, str(field_value)))
+            for owl_class in self.compiled_mapping.lookup_index(class_metadata).lookup(field_value, individual_ori):
+                statements.append(self.declare_new_individual(individual_ori, owl_class))
         else:
             # Force the class
-            ttl += self.declare_new_individual(individual_ori, class_metadata["value"])
+            statements.append(self.declare_new_individual(individual_ori, class_metadata["value"]))
 
         # Handle data and object properties
-        ttl += self.process_turtle_data_object_properties(individual_ori, mapping, individual_data)
-        ttl += self.close_individual()
+        statements += self.process_turtle_data_object_properties(individual_ori, mapping, individual_data)
 
-        # return "@prefix xsd:     <http://www.w3.org/2001/XMLSchema#> .\n\n" + ttl
-        return ttl
+        return self.serializer.individual(self.serializer.subject(individual_ori), statements)
 
     def process_turtle_data_object_properties(self, individual_ori, individual_mapping, individual_data, prefix=""):
 
-        ttl = ""
+        statements = []
         object_properties_metadata = individual_mapping.get("_object_properties", [])
 
         # Handle data properties
@@ -195,15 +209,25 @@ class JsonToRDFConverter:
             if type(location_property) is dict:
                 longitude_field = location_property['longitude']
                 latitude_field = location_property['latitude']
-                ttl += self.declare_location_property(individual_ori, individual_data, longitude_field, latitude_field)
+                location_statement = self.declare_location_property(individual_ori, individual_data, longitude_field,
+                                                                    latitude_field)
+                if location_statement is not None:
+                    statements.append(location_statement)
 
         if individual_mapping.get('_hidden_values') is not None:
             for hide_value, data_property_metadata in individual_mapping['_hidden_values'].items():
                 property_value = self.reach_value(hide_value, individual_data)
-                ttl += self.declare_data_property(individual_ori, data_property_metadata, property_value)
+                statements.append(self.declare_data_property(individual_ori, data_property_metadata, property_value))
+
 
+        # Only the fields declared by the mapping are processed, any other field would be ignored anyway
+        if prefix == "":
+            property_keys = [key for key in self.compiled_mapping.fields_of(individual_mapping)
+                             if key in individual_data]
+        else:
+            property_keys = individual_data
 
-        for property_key in individual_data:
+        for property_key in property_keys:
 
             # Retrieve its value
             property_value = individual_data[property_key]
@@ -240,8 +264,10 @@ class JsonToRDFConverter:
                         if generate_id == 'true':
                             # Id must be generated
 
-                            target_mapping = self.mapping[object_property_metadata["_mapping_id"]]
-                            target_mapping_id_metadata = target_mapping["_id"]
+                            target_mapping_id = object_property_metadata["_mapping_id"]
+                            target_mapping_id_metadata = self.mapping[target_mapping_id]["_id"]
+                            target_id_param = target_mapping_id_metadata["param"]
+                            target_id_static = target_mapping_id_metadata.get("static", "")
 
                             # Check if the property_value holds a list
                             if type(property_value) is list:
@@ -255,10 +281,11 @@ class JsonToRDFConverter:
                                         self.check_object_property_value_is_dict(property_sub_value, individual_ori,
                                                                                  object_property_ori)
 
-                                        targeted_individual_ori = target_mapping_id_metadata["static"] + str(
-                                            property_sub_value[target_mapping_id_metadata["param"]])
-                                        ttl += self.declare_object_property(individual_ori, object_property_ori,
-                                                                            targeted_individual_ori)
+                                        targeted_individual_term = self.serializer.generated_iri(
+                                            target_id_static, property_sub_value[target_id_param])
+                                        statements.append(self.declare_object_property_term(individual_ori,
+                                                                                            object_property_ori,
+                                                                                            targeted_individual_term))
                             else:
                                 # Ignore object_property if value is None
                                 if property_value is not None:
@@ -268,16 +295,17 @@ class JsonToRDFConverter:
                                     self.check_object_property_value_is_dict(property_value, individual_ori,
                                                                              object_property_ori)
 
-                                    targeted_individual_ori = target_mapping_id_metadata["static"] + str(
-                                            property_value[target_mapping_id_metadata["param"]])
-                                    ttl += self.declare_object_property(individual_ori, object_property_ori,
-                                                                        targeted_individual_ori)
+                                    targeted_individual_term = self.serializer.generated_iri(
+                                            target_id_static, property_value[target_id_param])
+                                    statements.append(self.declare_object_property_term(individual_ori,
+                                                                                        object_property_ori,
+                                                                                        targeted_individual_term))
 
                         elif generate_id == 'false':
                             # Id must not be generated
                             # Instead it must taken from the map <field_value, individual_ori> embedded into the object
                             # property metadata
-                            object_property_individuals_map = object_property_metadata["map"]
+                            object_property_index = self.compiled_mapping.lookup_index(object_property_metadata)
 
                             # Check if the property_value holds a list
                             if type(property_value) is list:
@@ -287,27 +315,23 @@ class JsonToRDFConverter:
                                     self.check_object_property_value_is_str(property_sub_value, individual_ori,
                                                                             object_property_ori)
 
-                                    # Check if the property_sub_value is contained in the object property individual map
-                                    self.check_object_property_value_is_in_map(property_sub_value,
-                                                                               object_property_individuals_map,
-                                                                               individual_ori, object_property_ori)
-
-                                    targeted_individual_ori = object_property_individuals_map[property_sub_value]
-                                    ttl += self.declare_object_property(individual_ori, object_property_ori,
-                                                                        targeted_individual_ori)
+                                    # Retrieve the targeted individuals from the object property individual map
+                                    for targeted_individual_ori in object_property_index.lookup(property_sub_value,
+                                                                                                individual_ori):
+                                        statements.append(self.declare_object_property(individual_ori,
+                                                                                       object_property_ori,
+                                                                                       targeted_individual_ori))
                             else:
                                 # Check if the property_sub_value is a string
                                 self.check_object_property_value_is_str(property_value, individual_ori,
                                                                         object_property_ori)
 
-                                # Check if the property_sub_value is contained in the object property individual map
-                                self.check_object_property_value_is_in_map(property_value,
-                                                                           object_property_individuals_map,
-                                                                           individual_ori, object_property_ori)
-
-                                targeted_individual_ori = object_property_individuals_map[property_value]
-                                ttl += self.declare_object_property(individual_ori, object_property_ori,
-                                                                    targeted_individual_ori)
+                                # Retrieve the targeted individuals from the object property individual map
+                                for targeted_individual_ori in object_property_index.lookup(property_value,
+                                                                                            individual_ori):
+                                    statements.append(self.declare_object_property(individual_ori,
+                                                                                   object_property_ori,
+                                                                                   targeted_individual_ori))
                         else :
                             # Custom generated iri
                             # Ignore object_property if value is None
@@ -325,8 +349,8 @@ class JsonToRDFConverter:
                             else:
                                 targeted_individual_ori = property_value
 
-                            ttl += self.declare_object_property(individual_ori, object_property_ori,
-                                                                targeted_individual_ori)
+                            statements.append(self.declare_object_property(individual_ori, object_property_ori,
+                                                                           targeted_individual_ori))
 
 
 
@@ -337,13 +361,13 @@ class JsonToRDFConverter:
                     # This test is probably useless, the test with the key_prefixed should be enough by itself
                     if property_key in individual_mapping:
                         data_property_metadata = individual_mapping[property_key]
-                        ttl += self.declare_data_property(individual_ori, data_property_metadata,
-                                                          property_value)
+                        statements.append(self.declare_data_property(individual_ori, data_property_metadata,
+                                                                     property_value))
                     # Check the key_prefixed version
                     elif key_prefixed in individual_mapping:
                         data_property_metadata = individual_mapping[property_key]
-                        ttl += self.declare_data_property(individual_ori, data_property_metadata,
-                                                          property_value)
+                        statements.append(self.declare_data_property(individual_ori, data_property_metadata,
+                                                                     property_value))
                     else:
                         # logger.warning(
                         #     "Could not find related metadata for the property {}. It will be ignored for the"
@@ -354,7 +378,7 @@ class JsonToRDFConverter:
                     "Detected key {} while processing data and object properties for individual with ori {}."
                     " field starting with a\"_\" symbol are ignored.".format(property_key, individual_ori))
 
-        return ttl
+        return statements
 
     def check_object_property_value_is_dict(self, property, individual_ori, object_property_ori):
         # Generate the ori for the targeted individual, property_value must be a dictionary
@@ -376,43 +400,36 @@ class JsonToRDFConverter:
                 " on object property {}, property_value was of type {}, expected either a str"
                 ".".format(individual_ori, object_property_ori, property_value_type))
 
-    def check_object_property_value_is_in_map(self, property_value, individuals_map, individual_ori,
-                                              object_property_ori):
-        if property_value not in individuals_map:
-            raise BaseException(
-                "Could not generate the targeted individual ori for the individual with ori"
-                " {}  on object property {}, property_value was : {}, it could not be"
-                " found into the object property individuals map {}"
-                ".".format(individual_ori, object_property_ori, property_value,
-                           str(individuals_map)))
-
     def declare_new_individual(self, individual_ori, owl_class):
-        return "<" + individual_ori + ">\ta\t<" + owl_class + "> .\n"
+        return self.serializer.TYPE_PREDICATE, self.serializer.iri(owl_class)
 
     def declare_object_property(self, individual_ori, object_property_ori, value):
-        return "<" + individual_ori + ">\t<" + object_property_ori + ">\t<" + str(value) + "> .\n"
+        return self.declare_object_property_term(individual_ori, object_property_ori,
+                                                 self.serializer.render_iri(value))
+
+    def declare_object_property_term(self, individual_ori, object_property_ori, value_term):
+        return self.serializer.iri(object_property_ori), value_term
 
     def declare_data_property(self, individual_ori, data_property_metadata, value):
 
         data_property_ori = data_property_metadata["datatype_property_ori"]
         data_property_datatype = data_property_metadata["type"]
 
-        ttl = "<" + individual_ori + ">\t<" + data_property_ori + ">\t"
-        ttl += self.switchDict[data_property_datatype](value)
-        ttl += " .\n"
-        return ttl
+        return self.serializer.iri(data_property_ori), self.switchDict[data_property_datatype](value)
 
     def declare_location_property(self, individual_ori, individual_data, longitude_field, latitude_field):
 
         latitude = self.reach_value(latitude_field, individual_data)
         longitude = self.reach_value(longitude_field, individual_data)
 
-        property_value = "{\"type\": \"Point\", \"coordinates\": [" + str(longitude) + ", " + str(latitude) + "]}\"^^xsd:string"
+        if latitude is None or longitude is None:
+            logger.warning("Missing coordinates for the individual with ori {}, its location is ignored."
+                           .format(individual_ori))
+            return None
 
-        ttl = "<" + individual_ori + ">\t<http://www.opengis.net/gml/pos>\t"
-        ttl += property_value
-        ttl += " .\n"
-        return ttl
+        property_value = "{\"type\": \"Point\", \"coordinates\": [" + str(longitude) + ", " + str(latitude) + "]}"
+
+        return self.serializer.iri(GML_POS_ORI), self.string(property_value)
 
     def reach_value(self, value_path, individual_data):
         value_path = value_path.split(self.separator)
@@ -430,24 +447,21 @@ class JsonToRDFConverter:
 
         return property_value
 
-    def close_individual(self):
-        return "\n"
-
     def boolean(self, value):
-        return "\"" + str(value) + "\"^^xsd:boolean"
+        return self.serializer.literal(value, "boolean")
 
     def integer(self, value):
-        return "\"" + str(value) + "\"^^xsd:integer"
+        return self.serializer.literal(value, "integer")
 
     def floatType(self, value):
-        return "\"" + str(value) + "\"^^xsd:float"
+        return self.serializer.literal(value, "float")
 
     def string(self, value):
-        return "\"" + str(value) + "\"^^xsd:string"
+        return self.serializer.literal(value, "string")
 
     def double(self, value):
-        return "\"" + str(value) + "\"^^xsd:double"
+        return self.serializer.literal(value, "double")
 
     def date(self, value):
-        return "\"" + str(datetime.strftime(parser.parse(str(value)), '%Y-%m-%dT%H:%M:%S.000Z')) + "\"^^xsd:date"
-
+        return self.serializer.literal(datetime.strftime(parser.parse(str(value)), '%Y-%m-%dT%H:%M:%S.000Z'),
+                                       "date")
\ No newline at end of file
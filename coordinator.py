@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from requests.adapters import HTTPAdapter
+
+from converter import JsonToRDFConverter
+from mapping import CompiledMapping
+from injector import BATCH_SIZE, DataManager
+from serializer import TurtleSerializer
+from state import SingletonState
+from ziggyClient import ZiggyHTTPClient
+
+logger = logging.getLogger()
+
+
+class InjectionJob:
+    # Payload to convert with mapping and to inject into namespace
+    def __init__(self, namespace, mapping, payload):
+        self.namespace = namespace
+        self.mapping = mapping
+        self.payload = payload
+
+
+class NamespaceReport:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.nb_objects = 0
+        self.injected_objects = 0
+        self.nb_batches = 0
+        self.injected_batches = 0
+        self.errors = []
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def failed(self):
+        return len(self.errors) > 0
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed_seconds
+        return self.injected_objects / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {"namespace": self.namespace,
+                "objects": self.nb_objects,
+                "injected_objects": self.injected_objects,
+                "batches": self.nb_batches,
+                "injected_batches": self.injected_batches,
+                "errors": [str(error) for error in self.errors],
+                "elapsed_seconds": self.elapsed_seconds,
+                "throughput": self.throughput}
+
+
+class ShardedInjectionCoordinator:
+    # Inject several jobs concurrently. Batches of every namespace are scheduled round-robin so a big tenant does not
+    # starve the others, with at most max_concurrency conversions or batches in flight overall and max_per_namespace
+    # batches per namespace. Jobs are converted as the injection goes, see next_job.
+    # Every namespace gets its own ZiggyHTTPClient but they all share the same connection pool, adapter may be given
+    # to use another transport (e.g. replay.ReplayAdapter).
+    # The injection is driven through SingletonState like DataManager.process_batch : a pause blocks the scheduling
+    # and the in-flight batches between their stages, a stop lets the in-flight batches finish.
+    # A job which fails to convert or a batch which fails to inject only cancels the remaining batches of its
+    # namespace, the failure is recorded into the report of the namespace.
+
+    def __init__(self, endpoint, max_concurrency=8, max_per_namespace=2, serializer_factory=None,
+                 dead_letter_file_path=None, adapter=None, **client_options):
+        self.endpoint = endpoint
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_per_namespace = max(max_per_namespace, 1)
+        # Conversions are CPU bound, they only get part of the slots so the injection keeps going
+        self.max_conversions = max(self.max_concurrency // 2, 1)
+        # Callable building the serializer of a mapping, the tab separated turtle is used by default
+        self.serializer_factory = serializer_factory
+        # Shared by every namespace, each record holds the namespace of the rejected individual
+        self.dead_letter_file_path = dead_letter_file_path
+        self.dead_letter_lock = threading.Lock()
+        # Forwarded to every ZiggyHTTPClient (rate limits, timeouts...)
+        self.client_options = client_options
+
+        self.adapter = adapter if adapter is not None else HTTPAdapter(pool_connections=self.max_concurrency,
+                                                                       pool_maxsize=self.max_concurrency)
+        self.clients = dict()
+        # Compiled mappings by mapping object, jobs sharing a mapping object share its lookup indexes. A compiled
+        # mapping holds its mapping so the id cannot be reused.
+        self.compiled_mappings = dict()
+        self.clients_lock = threading.Lock()
+
+    def get_client(self, namespace):
+        # Conversions run concurrently, each of them gets the client of its namespace
+        with self.clients_lock:
+            client = self.clients.get(namespace)
+            if client is None:
+                client = ZiggyHTTPClient(namespace, self.endpoint, adapter=self.adapter, **self.client_options)
+                self.clients[namespace] = client
+            return client
+
+    def get_compiled_mapping(self, mapping):
+        with self.clients_lock:
+            compiled_mapping = self.compiled_mappings.get(id(mapping))
+            if compiled_mapping is None:
+                compiled_mapping = CompiledMapping(mapping)
+                self.compiled_mappings[id(mapping)] = compiled_mapping
+            return compiled_mapping
+
+    def prepare(self, job):
+        # Convert the payload of the job and split it into batches of root projections
+        serializer = self.serializer_factory(job.mapping) if self.serializer_factory is not None \
+            else TurtleSerializer()
+        converter = JsonToRDFConverter(job.mapping, serializer=serializer,
+                                       compiled_mapping=self.get_compiled_mapping(job.mapping))
+        projections = list(converter.parse(job.payload).values())
+        data_manager = DataManager(self.get_client(job.namespace), job.mapping,
+                                   dead_letter_file_path=self.dead_letter_file_path, serializer=serializer,
+                                   dead_letter_lock=self.dead_letter_lock)
+        return [(data_manager, projections[index:index + BATCH_SIZE])
+                for index in range(0, len(projections), BATCH_SIZE)]
+
+    def run(self, jobs):
+        state = SingletonState.instance()
+
+        to_prepare = deque(jobs)
+        queues = dict()
+        reports = dict()
+        for job in to_prepare:
+            reports.setdefault(job.namespace, NamespaceReport(job.namespace))
+            queues.setdefault(job.namespace, deque())
+
+        # Objects are counted as the jobs get converted
+        state.begin_run(0)
+        logger.info("Injecting {} jobs into {} namespaces".format(len(to_prepare), len(queues)))
+
+        rotation = deque(queues)
+        # <future, (namespace, job)> of the conversions and <future, (namespace, projections)> of the batches
+        preparing = dict()
+        in_flight = dict()
+        namespace_in_flight = Counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while True:
+                while len(preparing) + len(in_flight) < self.max_concurrency and not state.is_stopped() \
+                        and state.get_state() != SingletonState.PAUSE:
+                    # Batches go first, conversions only take the slots left so the injection overlaps them
+                    namespace = self.next_namespace(rotation, queues, namespace_in_flight)
+                    if namespace is not None:
+                        data_manager, projections = queues[namespace].popleft()
+                        report = reports[namespace]
+                        if report.started_at is None:
+                            report.started_at = time.monotonic()
+                        state.batch_started()
+                        namespace_in_flight[namespace] += 1
+                        in_flight[executor.submit(data_manager.inject_batch, projections)] = (namespace, projections)
+                        continue
+
+                    job = self.next_job(to_prepare, queues, reports, preparing) \
+                        if len(preparing) < self.max_conversions else None
+                    if job is None:
+                        break
+                    preparing[executor.submit(self.prepare, job)] = (job.namespace, job)
+
+                pending = not state.is_stopped() and (len(to_prepare) > 0 or any(queues.values()))
+                if not in_flight and not preparing:
+                    if not pending:
+                        break
+                    # Paused with nothing in flight
+                    state.wait_while_paused()
+                    continue
+
+                # While paused with pending work, poll so the scheduling resumes promptly
+                done, _ = wait(list(preparing) + list(in_flight), timeout=1 if pending else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in preparing:
+                        self.prepared(future, preparing.pop(future), queues, reports)
+                        continue
+
+                    namespace, projections = in_flight.pop(future)
+                    namespace_in_flight[namespace] -= 1
+                    report = reports[namespace]
+                    report.finished_at = time.monotonic()
+                    try:
+                        future.result()
+                    except Exception as e:
+                        state.batch_aborted()
+                        logger.error("Batch of namespace {} failed, its remaining batches are cancelled : {}"
+                                     .format(namespace, e))
+                        report.errors.append(e)
+                        queues[namespace].clear()
+                        continue
+                    state.batch_done(len(projections))
+                    report.injected_batches += 1
+                    report.injected_objects += len(projections)
+
+        state.end_run()
+
+        for report in reports.values():
+            logger.info("Namespace {} : {}/{} objects injected in {:.1f}s ({:.1f} objects/s){}".format(
+                report.namespace, report.injected_objects, report.nb_objects, report.elapsed_seconds,
+                report.throughput, ", failed" if report.failed else ""))
+        return reports
+
+    def prepared(self, future, preparation, queues, reports):
+        # Queue the batches of a converted job, unless its namespace has already failed
+        namespace, job = preparation
+        report = reports[namespace]
+        try:
+            batches = future.result()
+        except BaseException as e:
+            # The converter raises BaseException on mapping errors (e.g. a value missing from a map)
+            logger.error("Conversion of a job of namespace {} failed, its remaining batches are cancelled : {}"
+                         .format(namespace, e))
+            report.errors.append(e)
+            queues[namespace].clear()
+            return
+        if report.failed:
+            return
+
+        nb_objects = sum(len(projections) for _, projections in batches)
+        report.nb_batches += len(batches)
+        report.nb_objects += nb_objects
+        queues[namespace].extend(batches)
+        SingletonState.instance().add_total_objects(nb_objects)
+
+    def next_job(self, to_prepare, queues, reports, preparing):
+        # Next job to convert. A namespace only gets its next job converted once its previous batches are all
+        # scheduled, and at most max_concurrency namespaces hold converted batches waiting to be injected, so the
+        # converted payloads held in memory stay bounded.
+        preparing_namespaces = set(namespace for namespace, _ in preparing.values())
+        nb_ready = sum(1 for queue in queues.values() if queue)
+        if nb_ready + len(preparing_namespaces) >= self.max_concurrency:
+            return None
+        for job in list(to_prepare):
+            if reports[job.namespace].failed:
+                # The remaining jobs of a failed namespace are cancelled
+                to_prepare.remove(job)
+            elif not queues[job.namespace] and job.namespace not in preparing_namespaces:
+                to_prepare.remove(job)
+                return job
+        return None
+
+    def next_namespace(self, rotation, queues, namespace_in_flight):
+        # Next namespace in the rotation having pending batches and room for one more batch in flight
+        for _ in range(len(rotation)):
+            namespace = rotation[0]
+            rotation.rotate(-1)
+            if queues[namespace] and namespace_in_flight[namespace] < self.max_per_namespace:
+                return namespace
+        return None
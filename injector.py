@@ -2,32 +2,51 @@ import json
 import logging
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from serializer import TurtleSerializer
 from state import SingletonState
+from validator import validate_turtle
+from ziggyClient import OVERLOAD_STATUS_CODES
 
 logger = logging.getLogger()
 
 BATCH_SIZE = 20
 MAX_FIND_SIZE = 500
 
+UUID_ORI = "http://orange-labs.fr/fog/ont/iot.owl#uuid"
+# Status codes meaning the batch content is at fault, the batch is split to isolate the faulty individuals
+CONTENT_ERROR_STATUS_CODES = (400, 413, 422)
+# Retries of a batch while the server is overloaded, the delay doubles after each attempt
+MAX_OVERLOAD_RETRIES = 4
+OVERLOAD_RETRY_DELAY = 5
+
 
 class DataManager:
-    def __init__(self, client, mapping):
+    def __init__(self, client, mapping, dead_letter_file_path=None, validate=True, serializer=None,
+                 dead_letter_lock=None):
         self.client = client
         self.mapping = mapping
+        # Must be the serializer used by the converter which generated the data
+        self.serializer = serializer if serializer is not None else TurtleSerializer()
+        # Buffers hold (ori, turtle) pairs so a rejected batch can be split by individual
         self.creation_batch_buffer = None
         self.update_batch_buffer = None
         self.nb_items = None
         self.total_objects_injected = None
 
-        self.find_batch_dict = None
-
-    
+        # Individuals rejected either by the local validation or by the server are appended to this JSONL file.
+        # DataManagers sharing the same file must share the same lock.
+        self.dead_letter_file_path = dead_letter_file_path
+        self.dead_letter_lock = dead_letter_lock if dead_letter_lock is not None else threading.Lock()
+        self.validate = validate
+        self.nb_dead_letters = 0
 
     def process(self, data, error_file_path, begin_index=0):
         logger.info("Number of elements in data: {}".format(len(data)))
-        self.creation_batch_buffer = ''
-        self.update_batch_buffer = ''
+        self.creation_batch_buffer = []
+        self.update_batch_buffer = []
         self.nb_items = 0
         self.total_objects_injected = 0
         for item in data:
@@ -36,8 +55,10 @@ class DataManager:
                 logger.info("item : " + str(item))
                 self.process_through_data(data[item])
                 if self.nb_items == BATCH_SIZE:
-                        self.send_data_to_create()
-                        self.send_data_to_update()
+                        self.send_data_to_create(self.creation_batch_buffer)
+                        self.send_data_to_update(self.update_batch_buffer)
+                        self.creation_batch_buffer = []
+                        self.update_batch_buffer = []
                         self.total_objects_injected += self.nb_items
                         self.nb_items = 0
             except:
@@ -45,10 +66,12 @@ class DataManager:
                     f.write(str(self.total_objects_injected + begin_index))
                 sys.exit(0)
 
-        if self.creation_batch_buffer != '':
+        if self.creation_batch_buffer or self.update_batch_buffer:
             try:
-                self.send_data_to_create()
-                self.send_data_to_update()
+                self.send_data_to_create(self.creation_batch_buffer)
+                self.send_data_to_update(self.update_batch_buffer)
+                self.creation_batch_buffer = []
+                self.update_batch_buffer = []
                 self.total_objects_injected += self.nb_items
                 self.nb_items = 0
             except:
@@ -73,14 +96,16 @@ class DataManager:
 
     def process_projection(self, projection):
         logger.info("Processing projection ... ")
+        if not self.is_valid(projection["_id"], projection["_data"]):
+            return
         response = self.client.get_projection_by_ori(projection["_id"])
         result = json.loads(response.content.decode('utf8'))
         if result['total_items'] == 0:
-            self.creation_batch_buffer = self.creation_batch_buffer + projection["_data"]
+            self.creation_batch_buffer.append((projection["_id"], projection["_data"]))
         else:
             result = result['items'][0]
-            rdf_uuid = '<' + result['_ori'] + '>\t<http://orange-labs.fr/fog/ont/iot.owl#uuid>\t\"' + result['_uuid'] + '\"^^xsd:string .\n'
-            self.update_batch_buffer = self.update_batch_buffer + rdf_uuid + projection["_data"]
+            rdf_uuid = self.declare_uuid(result['_ori'], result['_uuid'])
+            self.update_batch_buffer.append((projection["_id"], rdf_uuid + projection["_data"]))
 
 
     # Don't use this function for the moment
@@ -101,101 +126,198 @@ class DataManager:
         if len(uuids) > 0:
             self.client.delete_projection_batch(uuids)
 
-    def send_data_to_create(self):
+    def send_data_to_create(self, batch_buffer):
         # The buffer is empty
-        if not self.creation_batch_buffer:
+        if not batch_buffer:
             return
         print('Create query send')
-        self.creation_batch_buffer = "@prefix xsd:     <http://www.w3.org/2001/XMLSchema#> .\n\n" + self.creation_batch_buffer
-        create_result = self.client.create_projection_batch(self.creation_batch_buffer)
-        if create_result.status_code < 400:
-            print('Create query success')
-            logger.info("Insertion successfully done")
-        else:
-            logger.error("Insertion failed ! : status: {}  - {}, sended_batch: {}".format(create_result.status_code,
-                                                                        create_result.content, self.creation_batch_buffer))
-            #If a timeout exception is raised, sleep to allow the server to process the request
-            if create_result.status_code == 504:
-                time.sleep(30)
-        self.creation_batch_buffer = ''
-
-    def send_data_to_update(self):
+        self.send_batch(self.client.create_projection_batch, batch_buffer, "Insertion")
+
+    def send_data_to_update(self, batch_buffer):
         # The buffer is empty
-        if not self.update_batch_buffer:
+        if not batch_buffer:
             return
         print('Update query send')
-        self.update_batch_buffer = "@prefix xsd:     <http://www.w3.org/2001/XMLSchema#> .\n\n" + self.update_batch_buffer
-        update_result = self.client.update_replace_projection_batch(self.update_batch_buffer)
-        if update_result.status_code < 400:
-            print('Update query success')
-            logger.info("Insertion successfully done")
-        else:
-            print("Insertion failed ! : status: {}  - {}".format(update_result.status_code,
-                                                                        update_result.content))
-            logger.error("Insertion failed ! : status: {}  - {}".format(update_result.status_code,
-                                                                        update_result.content))
+        self.send_batch(self.client.update_replace_projection_batch, batch_buffer, "Update")
+
+    def send_batch(self, send_function, batch_buffer, operation):
+        # Send the (ori, turtle) pairs of batch_buffer. While the server is overloaded the batch is sent again after
+        # a delay. When the server rejects the content of the batch it is split in two halves which are sent again
+        # until the faulty individuals are isolated into the dead letter file. Any other error raises so the batch
+        # is counted as failed.
+        document = self.serializer.document([data for _, data in batch_buffer])
+        attempt = 0
+        while True:
+            result = send_function(document)
+            if result.status_code < 400:
+                print('{} query success'.format(operation))
+                logger.info("{} successfully done".format(operation))
+                return
+
+            logger.error("{} failed ! : status: {}  - {}, batch size: {}".format(operation, result.status_code,
+                                                                                result.content, len(batch_buffer)))
+            if result.status_code not in OVERLOAD_STATUS_CODES or attempt == MAX_OVERLOAD_RETRIES:
+                break
+            delay = OVERLOAD_RETRY_DELAY * 2 ** attempt
             # If a timeout exception is raised, sleep to allow the server to process the request
-            if update_result.status_code == 504:
-                time.sleep(30)
-
-        self.update_batch_buffer = ''
+            if result.status_code == 504:
+                delay = max(delay, 30)
+            logger.warning("Server overloaded, {} retried in {}s".format(operation, delay))
+            time.sleep(delay)
+            attempt += 1
+
+        content = result.content.decode('utf8', errors='replace')
+        if result.status_code not in CONTENT_ERROR_STATUS_CODES:
+            raise Exception("{} failed with status {} : {}".format(operation, result.status_code, content))
+
+        if len(batch_buffer) == 1:
+            ori, data = batch_buffer[0]
+            self.dead_letter(ori, data, "{} rejected with status {} : {}".format(operation, result.status_code,
+                                                                                 content))
+            return
 
-    def process_batch(self, data, error_file_path, begin_index=0):
+        middle = len(batch_buffer) // 2
+        self.send_batch(send_function, batch_buffer[:middle], operation)
+        self.send_batch(send_function, batch_buffer[middle:], operation)
+
+    def is_valid(self, ori, data):
+        if not self.validate:
+            return True
+        error = validate_turtle(data.decode('utf-8') if isinstance(data, bytes) else data)
+        if error is None:
+            return True
+        self.dead_letter(ori, data, "Invalid turtle : {}".format(error))
+        return False
+
+    def declare_uuid(self, ori, uuid):
+        # The update endpoints identify the projection to update with its uuid
+        return self.serializer.individual(self.serializer.subject(ori),
+                                          [(self.serializer.iri(UUID_ORI), self.serializer.literal(uuid, "string"))])
+
+    def dead_letter(self, ori, data, reason):
+        logger.error("Individual {} discarded : {}".format(ori, reason))
+        with self.dead_letter_lock:
+            self.nb_dead_letters += 1
+            if self.dead_letter_file_path is not None:
+                with open(self.dead_letter_file_path, "a") as f:
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    f.write(json.dumps({"namespace": self.client.namespace, "_id": ori, "_data": data,
+                                        "reason": reason}) + "\n")
+
+    def process_batch(self, data, error_file_path, begin_index=0, nb_workers=1):
+        # A PAUSE no longer makes this method return : the workers block in place until the injector is resumed or
+        # stopped. STOP is the way to checkpoint, the in-flight batches are finished and the index to resume from
+        # is written to error_file_path before returning, as it is when a batch fails.
 
         state = SingletonState.instance()
+        nb_workers = max(nb_workers, 1)
 
         logger.info("Number of elements in data: {}".format(len(data)))
 
         data_values = list(data.values())
-        batch_total_loop = float(len(data_values)) / BATCH_SIZE
-        nb_loop = 0
+        # About Object in data_values, those are most likely root object with childrens, meaning the number of object to inject > BATCH_SIZE
+        batches = [data_values[index:index + BATCH_SIZE] for index in range(0, len(data_values), BATCH_SIZE)]
         self.total_objects_injected = 0
-        self.update_batch_buffer = ""
-        self.creation_batch_buffer = ""
+        state.begin_run(len(data_values))
+
+        # Batches may complete out of order with several workers, only the contiguous prefix of completed batches
+        # is considered as injected when computing the index to resume from.
+        completed_batches = set()
+        nb_contiguous_batches = 0
+        in_flight = dict()
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            batch_index = 0
+            while True:
+                can_submit = batch_index < len(batches) and len(in_flight) < nb_workers \
+                    and failure is None and not state.is_stopped()
+
+                if can_submit and (not in_flight or state.get_state() != SingletonState.PAUSE):
+                    # Blocks here as long as the injector is paused and no batch is in flight
+                    if state.wait_while_paused():
+                        state.batch_started()
+                        in_flight[executor.submit(self.inject_batch, batches[batch_index])] = batch_index
+                        batch_index += 1
+                    continue
+
+                if not in_flight:
+                    # Every batch has been injected, or the injection has been stopped or has failed
+                    break
+
+                # While paused with a free worker, poll so the next batch is submitted promptly on resume
+                done, _ = wait(list(in_flight), timeout=1 if can_submit else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = in_flight.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        state.batch_aborted()
+                        logger.error("Batch {} failed : {}".format(index, e))
+                        if failure is None:
+                            failure = e
+                        continue
+                    state.batch_done(len(batches[index]))
+                    completed_batches.add(index)
+
+                while nb_contiguous_batches in completed_batches:
+                    nb_contiguous_batches += 1
+                self.total_objects_injected = min(nb_contiguous_batches * BATCH_SIZE, len(data_values))
+
+        if failure is not None or state.is_stopped():
+            with open(os.path.join(error_file_path), "w") as f:
+                f.write(str(self.total_objects_injected + begin_index))
+        state.end_run()
 
-        while nb_loop < batch_total_loop and state.get_state() != 'STOP' and state.get_state() != 'PAUSE':
-            self.find_batch_dict = {}
+        if failure is not None:
+            raise failure
 
-            # About Object in data_values, those are most likely root object with childrens, meaning the number of object to inject > BATCH_SIZE
-            for projection in data_values[:BATCH_SIZE]:
-                self.process_through_data_batch(projection)
+    def inject_batch(self, projections):
+        # Inject a batch of root projections, this method holds no state on the DataManager and may run concurrently.
+        # A pause blocks the batch between each stage, a stop lets the batch finish so it is not lost.
+        state = SingletonState.instance()
+        find_batch_dict = {}
 
-            self.process_projection_batch()
-            self.send_data_to_create()
-            self.send_data_to_update()
-            # Slicing off data_values we just processed into thingin (be it through update or create)
-            data_values = data_values[(BATCH_SIZE - len(data_values)):]
-            nb_loop += 1
-            self.total_objects_injected = nb_loop * BATCH_SIZE
+        for projection in projections:
+            self.process_through_data_batch(projection, find_batch_dict)
 
-        if state.get_state() == 'PAUSE':
-            with open(os.path.join(error_file_path), "w") as f:
-                f.write(str(self.total_objects_injected + begin_index))
+        state.wait_while_paused()
+        creation_batch_buffer, update_batch_buffer = self.process_projection_batch(find_batch_dict)
 
-    def process_through_data_batch(self, data):
+        state.wait_while_paused()
+        self.send_data_to_create(creation_batch_buffer)
+
+        state.wait_while_paused()
+        self.send_data_to_update(update_batch_buffer)
+
+    def process_through_data_batch(self, data, find_batch_dict):
 
         items = data['_items']
 
         if items:
             logger.info("node")
             for item in items:
-                self.process_through_data_batch(items[item])
-            self.find_batch_dict[data['_id']] = {'_data': data['_data'], '_id': data['_id']}
+                self.process_through_data_batch(items[item], find_batch_dict)
+            if self.is_valid(data['_id'], data['_data']):
+                find_batch_dict[data['_id']] = {'_data': data['_data'], '_id': data['_id']}
         else:
             # Leaf
             logger.info("leaf")
-            self.find_batch_dict[data['_id']] = {'_data': data['_data'], '_id': data['_id']}
+            if self.is_valid(data['_id'], data['_data']):
+                find_batch_dict[data['_id']] = {'_data': data['_data'], '_id': data['_id']}
 
-    def process_projection_batch(self):
+    def process_projection_batch(self, find_batch_dict):
 
         logger.info("Processing projections ... ")
 
-        oris = [ori for ori in self.find_batch_dict]
-        nb_finds = float(len(oris) / MAX_FIND_SIZE)
-        loop = 0
-        while loop < nb_finds:
+        creation_batch_buffer = []
+        update_batch_buffer = []
 
-            response = self.client.get_projections_by_ori(oris[:MAX_FIND_SIZE], MAX_FIND_SIZE)
+        oris = [ori for ori in find_batch_dict]
+        for index in range(0, len(oris), MAX_FIND_SIZE):
+
+            response = self.client.get_projections_by_ori(oris[index:index + MAX_FIND_SIZE], MAX_FIND_SIZE)
 
             if response.status_code == 504:
                 raise Exception('Request timed out from Thing\'in api, try again later')
@@ -206,15 +328,14 @@ class DataManager:
             else:
                 result = result['items']
                 for item in result:
-                    self.find_batch_dict[item['_ori']]['_uuid'] = item['_uuid']
-            loop += 1
-            oris = oris[(MAX_FIND_SIZE - len(oris)):]
+                    find_batch_dict[item['_ori']]['_uuid'] = item['_uuid']
 
-        for ori in self.find_batch_dict:
-            if self.find_batch_dict[ori].get('_uuid') is None:
-                self.creation_batch_buffer = self.creation_batch_buffer + self.find_batch_dict[ori]["_data"]
+        for ori in find_batch_dict:
+            if find_batch_dict[ori].get('_uuid') is None:
+                creation_batch_buffer.append((ori, find_batch_dict[ori]["_data"]))
             else:
-                projection = self.find_batch_dict[ori]
-                rdf_uuid = '<' + projection['_id'] + '>\t<http://orange-labs.fr/fog/ont/iot.owl#uuid>\t\"' + projection[
-                    '_uuid'] + '\"^^xsd:string .\n'
-                self.update_batch_buffer = self.update_batch_buffer + rdf_uuid + projection["_data"]
\ No newline at end of file
+                projection = find_batch_dict[ori]
+                rdf_uuid = self.declare_uuid(projection['_id'], projection['_uuid'])
+                update_batch_buffer.append((ori, rdf_uuid + projection["_data"]))
+
+        return creation_batch_buffer, update_batch_buffer
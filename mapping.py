@@ -0,0 +1,276 @@
+import json
+import logging
+from itertools import islice
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger()
+
+ON_MISSING_ERROR = "error"
+ON_MISSING_SKIP = "skip"
+ON_MISSING_DEFAULT = "default"
+
+# Number of keys displayed in error messages, maps can hold thousands of entries
+MAX_DISPLAYED_KEYS = 5
+
+
+class LookupIndex:
+    # Validated and normalised form of a "map" of the mapping (<field value, IRI(s)>), built once at mapping load.
+    # Options are read next to the map in the mapping :
+    #  - "case_insensitive": keys and looked up values are compared case-insensitively
+    #  - "multi_value_separator": looked up values are split on this separator and each part is looked up
+    #  - "on_missing": "error" (default), "skip" or "default" when a value is not in the map
+    #  - "default": IRI(s) used when "on_missing" is "default"
+    # A map entry may hold a list of IRIs, each of them is then targeted.
+
+    def __init__(self, name, individuals_map, case_insensitive=False, multi_value_separator=None,
+                 on_missing=ON_MISSING_ERROR, default=None):
+        self.name = name
+        self.case_insensitive = case_insensitive
+        self.multi_value_separator = multi_value_separator
+        self.on_missing = on_missing
+
+        if type(individuals_map) is not dict:
+            raise Exception("The map of {} must be an object, got {}.".format(name, type(individuals_map).__name__))
+        if on_missing not in (ON_MISSING_ERROR, ON_MISSING_SKIP, ON_MISSING_DEFAULT):
+            raise Exception("Unknown on_missing value {} for {}, expected one of error, skip or default."
+                            .format(on_missing, name))
+
+        self.default = ()
+        if on_missing == ON_MISSING_DEFAULT:
+            if default is None:
+                raise Exception("{} is configured with on_missing set to default but has no default.".format(name))
+            self.default = self.normalise_targets(default, "default")
+
+        self.index = dict()
+        for key, targets in individuals_map.items():
+            normalised_key = self.normalise_key(key)
+            if normalised_key in self.index:
+                logger.warning("Key {} of {} collides with another key once normalised, it overrides it."
+                               .format(key, name))
+            self.index[normalised_key] = self.normalise_targets(targets, key)
+
+    @classmethod
+    def from_metadata(cls, name, metadata):
+        return cls(name, metadata["map"],
+                   case_insensitive=metadata.get("case_insensitive", False),
+                   multi_value_separator=metadata.get("multi_value_separator"),
+                   on_missing=metadata.get("on_missing", ON_MISSING_ERROR),
+                   default=metadata.get("default"))
+
+    def normalise_key(self, key):
+        key = str(key)
+        return key.casefold() if self.case_insensitive else key
+
+    def normalise_targets(self, targets, key):
+        if type(targets) is str:
+            return (targets,)
+        if type(targets) is list and targets and all(type(target) is str for target in targets):
+            return tuple(targets)
+        raise Exception("The entry {} of {} must be an IRI or a non empty list of IRIs.".format(key, self.name))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, value):
+        return self.normalise_key(value) in self.index
+
+    def lookup(self, value, individual_ori):
+        # Return the tuple of IRIs targeted by value, it is empty when the value has to be skipped
+        if self.multi_value_separator is not None and type(value) is str and self.multi_value_separator in value:
+            targets = ()
+            for part in value.split(self.multi_value_separator):
+                part = part.strip()
+                if part:
+                    targets += self.lookup_single(part, individual_ori)
+            return targets
+        return self.lookup_single(value, individual_ori)
+
+    def lookup_single(self, value, individual_ori):
+        targets = self.index.get(self.normalise_key(value))
+        if targets is not None:
+            return targets
+        if self.on_missing == ON_MISSING_ERROR:
+            raise BaseException(
+                "Could not find the value {} for the individual with ori {} into {} ({} entries, e.g. {})."
+                .format(value, individual_ori, self.name, len(self.index),
+                        ", ".join(islice(self.index, MAX_DISPLAYED_KEYS))))
+        if self.on_missing == ON_MISSING_SKIP:
+            logger.debug("Value %s of individual %s not found into %s, it is skipped.", value, individual_ori,
+                         self.name)
+        return self.default
+
+
+class CompiledMapping:
+    # Indexes built once from a mapping and shared by every conversion using it.
+    # Metadata objects of the mapping are never copied, indexes are stored by the identity of the metadata
+    # they were built from.
+
+    def __init__(self, mapping, separator='.'):
+        self.mapping = mapping
+        self.separator = separator
+        self.lookup_indexes = dict()
+        # Fields of an individual which are declared as data or object properties by its mapping
+        self.property_fields = dict()
+        self._projection = None
+
+        for mapping_id, mapping_data in mapping.items():
+            if mapping_id in ("skeleton", "_mapping_id") or type(mapping_data) is not dict:
+                continue
+
+            fields = [key for key in mapping_data if not key.startswith("_")]
+            for object_property_metadata in mapping_data.get("_object_properties", []):
+                if object_property_metadata["field"] not in fields:
+                    fields.append(object_property_metadata["field"])
+            self.property_fields[id(mapping_data)] = tuple(fields)
+
+            class_metadata = mapping_data.get("_class")
+            if class_metadata is not None and class_metadata.get("field_dependent"):
+                self.lookup_indexes[id(class_metadata)] = LookupIndex.from_metadata(
+                    "the class map of {}".format(mapping_id), class_metadata)
+
+            for object_property_metadata in mapping_data.get("_object_properties", []):
+                if object_property_metadata.get("generate_id") == 'false':
+                    self.lookup_indexes[id(object_property_metadata)] = LookupIndex.from_metadata(
+                        "the individuals map of the object property {} of {}".format(
+                            object_property_metadata.get("object_property_ori"), mapping_id),
+                        object_property_metadata)
+
+    def lookup_index(self, metadata):
+        return self.lookup_indexes[id(metadata)]
+
+    def fields_of(self, mapping_data):
+        return self.property_fields[id(mapping_data)]
+
+    @property
+    def projection(self):
+        # Tree of the input fields read by the mapping, see project
+        if self._projection is None:
+            self._projection = self.skeleton_projection(self.mapping["skeleton"])
+        return self._projection
+
+    def skeleton_projection(self, skeleton):
+        # Lists are transparent, the projection of their elements applies
+        if type(skeleton) is list:
+            return self.skeleton_projection(skeleton[0])
+
+        mapping_data = self.mapping[skeleton["_mapping_id"]]
+        projection = {field: None for field in self.fields_of(mapping_data)}
+        # Generated object properties only read the id of the targeted individuals
+        for object_property_metadata in mapping_data.get("_object_properties", []):
+            if object_property_metadata.get("generate_id") == 'true':
+                target_param = self.mapping[object_property_metadata["_mapping_id"]]["_id"]["param"]
+                projection[object_property_metadata["field"]] = path_projection(target_param.split(self.separator))
+
+        paths = [mapping_data["_id"]["param"]]
+        class_metadata = mapping_data.get("_class", {})
+        if class_metadata.get("field_dependent"):
+            paths.append(class_metadata["field"])
+        location_property = mapping_data.get("_location")
+        if type(location_property) is dict:
+            paths += [location_property["longitude"], location_property["latitude"]]
+        paths += list(mapping_data.get("_hidden_values", {}))
+        for path in paths:
+            merge_projection(projection, path_projection(path.split(self.separator)))
+
+        for key, child_skeleton in skeleton.items():
+            if key not in ("_mapping_id", "_recursive", "_recursive_field"):
+                merge_projection(projection, {key: self.skeleton_projection(child_skeleton)})
+
+        # Recursive individuals are kept whole rather than building a cyclic projection
+        if skeleton.get("_recursive", False) and skeleton.get("_recursive_field") is not None:
+            projection[skeleton["_recursive_field"]] = None
+        return projection
+
+
+def path_projection(path):
+    projection = None
+    for param in reversed(path):
+        projection = {param: projection}
+    return projection
+
+
+def merge_projection(projection, other):
+    # A None projection keeps the whole value, it wins over any partial projection
+    for key, other_child in other.items():
+        if key not in projection:
+            projection[key] = other_child
+        elif projection[key] is not None:
+            if other_child is None:
+                projection[key] = None
+            else:
+                merge_projection(projection[key], other_child)
+
+
+def project(data, projection):
+    # Drop the fields of data which are not part of the projection. A projection is a dict of
+    # <field, sub projection>, None keeps the whole value and lists are projected element by element.
+    if projection is None:
+        return data
+    if type(data) is list:
+        if is_index_projection(projection):
+            return data
+        return [project(element, projection) for element in data]
+    if type(data) is not dict:
+        # The key paths of the projection may contain list indexes, keep the value
+        return data
+    return {key: project(value, projection[key]) for key, value in data.items() if key in projection}
+
+
+def is_index_projection(projection):
+    # Paths reaching a list element by its index keep the whole list
+    return any(key.isdigit() for key in projection)
+
+
+def load_projected(stream, projection, streaming=False):
+    # Load a JSON document from a binary stream keeping only the projected fields. The whole document is loaded
+    # then projected, it is the fastest way. With streaming, ijson builds the projected document from the parsing
+    # events so the skipped subtrees are never turned into python objects : the memory peak is lower but the
+    # loading is slower.
+    if not streaming:
+        return project(json.load(stream), projection)
+    if ijson is None:
+        raise Exception("ijson must be installed to load a JSON document in streaming.")
+    events = ijson.parse(stream, use_float=True)
+    _, event, value = next(events)
+    return build_projected(event, value, events, projection)
+
+
+def build_projected(event, value, events, projection):
+    if event == "start_map":
+        result = dict()
+        for _, event, value in events:
+            if event == "end_map":
+                return result
+            # map_key event, value is the key
+            if projection is None:
+                _, child_event, child_value = next(events)
+                result[value] = build_projected(child_event, child_value, events, None)
+            elif value in projection:
+                _, child_event, child_value = next(events)
+                result[value] = build_projected(child_event, child_value, events, projection[value])
+            else:
+                skip_value(events)
+    elif event == "start_array":
+        if projection is not None and is_index_projection(projection):
+            projection = None
+        result = []
+        for _, event, value in events:
+            if event == "end_array":
+                return result
+            result.append(build_projected(event, value, events, projection))
+    return value
+
+
+def skip_value(events):
+    depth = 0
+    for _, event, _ in events:
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            return
@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ziggyClient import ZiggyHTTPClient
+
+logger = logging.getLogger()
+
+
+def body_bytes(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return body
+
+
+def body_hash(body):
+    return hashlib.sha1(body_bytes(body)).hexdigest()
+
+
+def split_entry(path):
+    # Split an url path relative to the endpoint into its entry and its query string
+    entry, _, query = path.partition("?")
+    return entry, query
+
+
+class TrafficRecorder:
+    # Append every ZiggyHTTPClient call and its response to a JSONL file, one record per line.
+    # Request bodies are only stored as a hash unless record_bodies is set, responses are always stored as they are
+    # needed to replay the finds.
+
+    def __init__(self, path, record_bodies=False):
+        self.path = path
+        self.record_bodies = record_bodies
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.file = open(path, "w")
+
+    def record(self, client, method, url, kwargs, response, latency, triples=0, error=None):
+        # response is None when the request failed without response (timeout, connection error), its status is
+        # then recorded as null.
+        body = kwargs.get("data")
+        if body is None and kwargs.get("json") is not None:
+            body = json.dumps(kwargs["json"])
+        body = body_bytes(body)
+
+        entry, query = split_entry(url[len(client.endpoint):] if url.startswith(client.endpoint) else url)
+        record = {"t": time.monotonic() - self.started_at - latency,
+                  "namespace": client.namespace,
+                  "method": method,
+                  "entry": entry,
+                  "query": query,
+                  "request_size": len(body),
+                  "body_hash": body_hash(body),
+                  "triples": triples,
+                  "status": response.status_code if response is not None else None,
+                  "latency": latency,
+                  "response": response.content.decode('utf8', errors='replace') if response is not None else ""}
+        if error is not None:
+            record["error"] = str(error)
+        if self.record_bodies:
+            record["body"] = body.decode('utf8', errors='replace')
+
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayMatcher:
+    # Answer requests from a recording. A request identical to a recorded one gets the recorded response, finds on
+    # oris are answered from every projection seen in the recorded finds so that a different batching still gets
+    # consistent results, any other request gets the next recorded response of the same entry.
+
+    def __init__(self, records):
+        self.lock = threading.Lock()
+        self.exact = defaultdict(deque)
+        self.by_entry = defaultdict(list)
+        self.entry_positions = Counter()
+        self.latencies = defaultdict(list)
+        self.projections = dict()
+
+        for record in records:
+            key = (record["method"], record["entry"])
+            self.exact[key + (record["body_hash"],)].append(record)
+            self.by_entry[key].append(record)
+            self.latencies[key].append(record["latency"])
+            if record["entry"] == ZiggyHTTPClient.PROJECTION_FIND_ENTRY and record["status"] is not None \
+                    and record["status"] < 400:
+                try:
+                    items = json.loads(record["response"]).get("items", [])
+                except ValueError:
+                    continue
+                for item in items:
+                    if "_ori" in item:
+                        self.projections[item["_ori"]] = item
+
+    def match(self, method, entry, body):
+        # Return (status, response content, recorded latency), status is None for a request recorded as failed
+        key = (method, entry)
+        with self.lock:
+            records = self.exact.get(key + (body_hash(body),))
+            if records:
+                record = records.popleft()
+                return record["status"], record["response"], record["latency"]
+
+            latencies = self.latencies.get(key) or [0.0]
+            latency = sum(latencies) / len(latencies)
+
+            if entry == ZiggyHTTPClient.PROJECTION_FIND_ENTRY:
+                oris = self.find_oris(body)
+                if oris is not None:
+                    items = [self.projections[ori] for ori in oris if ori in self.projections]
+                    return 200, json.dumps({"total_items": len(items), "items": items}), latency
+
+            records = self.by_entry.get(key)
+            if not records:
+                logger.warning("No recorded response for {} {}".format(method, entry))
+                return 404, "", 0.0
+            # Sequential replay, the last response is repeated once the recording is exhausted
+            position = min(self.entry_positions[key], len(records) - 1)
+            self.entry_positions[key] += 1
+            record = records[position]
+            return record["status"], record["response"], record["latency"]
+
+    def find_oris(self, body):
+        try:
+            query = json.loads(body_bytes(body).decode('utf8')).get("query", {})
+        except ValueError:
+            return None
+        ori = query.get("$ori")
+        if isinstance(ori, str):
+            return [ori]
+        if isinstance(ori, dict) and isinstance(ori.get("$in"), list):
+            return ori["$in"]
+        return None
+
+
+def replay_delay(latency, speed):
+    # speed is None to answer immediately, 1 to respect the recorded latencies, 2 to go twice as fast...
+    if speed:
+        time.sleep(latency / speed)
+
+
+class ReplayAdapter(HTTPAdapter):
+    # requests transport answering from a recording instead of the network, give it to ZiggyHTTPClient as adapter
+
+    def __init__(self, records, endpoint, speed=None):
+        super().__init__()
+        self.matcher = ReplayMatcher(records)
+        self.endpoint = str(endpoint)
+        if not self.endpoint.endswith("/"):
+            self.endpoint += "/"
+        self.speed = speed
+        self.nb_requests = 0
+        self.counter_lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = request.url
+        entry, _ = split_entry(url[len(self.endpoint):] if url.startswith(self.endpoint) else urlsplit(url).path)
+        status, content, latency = self.matcher.match(request.method, entry, request.body)
+        replay_delay(latency, self.speed)
+        with self.counter_lock:
+            self.nb_requests += 1
+        if status is None:
+            raise requests.ConnectionError("Recorded request {} {} failed without response".format(request.method,
+                                                                                                 entry),
+                                           request=request)
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = content.encode('utf-8')
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = 'utf-8'
+        response.url = url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def replay_client(recording_path, namespace, endpoint="http://replay/", speed=None, recorder=None):
+    # ZiggyHTTPClient answered from a recording, give it a recorder to record the replayed run
+    adapter = ReplayAdapter(load_records(recording_path), endpoint, speed)
+    return ZiggyHTTPClient(namespace, endpoint, adapter=adapter, recorder=recorder)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_any(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        entry, _ = split_entry(self.path.lstrip("/"))
+        status, content, latency = self.server.matcher.match(self.command, entry, body)
+        replay_delay(latency, self.server.speed)
+
+        if status is None:
+            # The recorded request failed without response, drop the connection
+            self.close_connection = True
+            return
+        content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+    def log_message(self, format, *args):
+        logger.debug("Replay stub - " + format % args)
+
+
+def serve_stub(records, host="127.0.0.1", port=0, speed=None):
+    # Local server answering from a recording, point ZiggyHTTPClient to http://host:port/
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.matcher = ReplayMatcher(records)
+    server.speed = speed
+    thread = threading.Thread(target=server.serve_forever, name="replay-stub", daemon=True)
+    thread.start()
+    logger.info("Replay stub listening on http://{}:{}/".format(host, server.server_port))
+    return server
+
+
+def summarize(records):
+    summary = {"requests": len(records),
+               "requests_by_entry": Counter("{} {}".format(record["method"], record["entry"]) for record in records),
+               "status": Counter(record["status"] for record in records),
+               "request_bytes": sum(record["request_size"] for record in records),
+               "triples": sum(record["triples"] for record in records),
+               "duration": 0.0}
+    if records:
+        begin = min(record["t"] for record in records)
+        end = max(record["t"] + record["latency"] for record in records)
+        summary["duration"] = end - begin
+    duration = summary["duration"]
+    summary["requests_per_second"] = summary["requests"] / duration if duration > 0 else 0.0
+    summary["triples_per_second"] = summary["triples"] / duration if duration > 0 else 0.0
+    return summary
+
+
+def compare(baseline_records, candidate_records):
+    baseline = summarize(baseline_records)
+    candidate = summarize(candidate_records)
+    lines = ["{:<40} {:>14} {:>14} {:>10}".format("", "baseline", "candidate", "ratio")]
+
+    def add_line(name, baseline_value, candidate_value):
+        ratio = "{:.2f}".format(candidate_value / baseline_value) if baseline_value else "-"
+        lines.append("{:<40} {:>14.2f} {:>14.2f} {:>10}".format(name, baseline_value, candidate_value, ratio))
+
+    for name in ("requests", "request_bytes", "triples", "duration", "requests_per_second", "triples_per_second"):
+        add_line(name, baseline[name], candidate[name])
+    for entry in sorted(set(baseline["requests_by_entry"]) | set(candidate["requests_by_entry"])):
+        add_line(entry, baseline["requests_by_entry"][entry], candidate["requests_by_entry"][entry])
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, compare and replay recorded Thing'in traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser("summary", help="Summarize a recording")
+    summary_parser.add_argument("recording")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two recordings")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve a recording from a local stub server")
+    serve_parser.add_argument("recording")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--speed", type=float, default=None,
+                              help="1 to respect the recorded latencies, 2 to go twice as fast, none by default")
+
+    args = parser.parse_args()
+    if args.command == "summary":
+        summary = summarize(load_records(args.recording))
+        print(json.dumps(summary, indent=4))
+    elif args.command == "compare":
+        print(compare(load_records(args.baseline), load_records(args.candidate)))
+    elif args.command == "serve":
+        logging.basicConfig(level=logging.INFO)
+        server = serve_stub(load_records(args.recording), args.host, args.port, args.speed)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import re
+
+XSD_NAMESPACE = "http://www.w3.org/2001/XMLSchema#"
+RDF_TYPE_ORI = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+# Characters which must be escaped inside a turtle or n-triples string literal
+LITERAL_ESCAPES = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n", "\r": "\\r"})
+
+# Local names which can be written as is after a prefix, anything else is written as a full IRI
+SAFE_LOCAL_NAME_REGEX = re.compile(r"^(?:[A-Za-z0-9_](?:[A-Za-z0-9_.-]*[A-Za-z0-9_-])?)?$")
+
+
+def escape_literal(value):
+    value = str(value)
+    # Most values hold nothing to escape, avoid the translation in that case
+    if "\"" in value or "\\" in value or "\n" in value or "\r" in value:
+        return value.translate(LITERAL_ESCAPES)
+    return value
+
+
+class TurtleSerializer:
+    # Tab separated turtle, one statement per line with full IRIs.
+    # Terms coming from the mapping (predicates, classes) are rendered once and cached, individuals are assembled
+    # with a single join of the rendered terms.
+    TYPE_PREDICATE = "a"
+
+    def __init__(self):
+        self.iri_terms = dict()
+        self.datatype_suffixes = dict()
+        self.id_prefixes = dict()
+
+    def header(self):
+        return "@prefix xsd:     <" + XSD_NAMESPACE + "> .\n\n"
+
+    def document(self, chunks):
+        # Assemble a whole request body from rendered individuals
+        return self.header() + "".join(chunks)
+
+    def iri(self, ori):
+        # Only use it for terms of the mapping, the cache is never emptied
+        term = self.iri_terms.get(ori)
+        if term is None:
+            term = self.render_iri(ori)
+            self.iri_terms[ori] = term
+        return term
+
+    def render_iri(self, ori):
+        return "<" + str(ori) + ">"
+
+    def subject(self, ori):
+        return self.render_iri(ori)
+
+    def generated_iri(self, static, value):
+        # IRI of an individual generated from the static part of a mapping "_id" and an id value
+        prefix = self.id_prefixes.get(static)
+        if prefix is None:
+            prefix = "<" + static
+            self.id_prefixes[static] = prefix
+        return prefix + str(value) + ">"
+
+    def datatype_suffix(self, datatype):
+        return "\"^^xsd:" + datatype
+
+    def literal(self, value, datatype):
+        suffix = self.datatype_suffixes.get(datatype)
+        if suffix is None:
+            suffix = self.datatype_suffix(datatype)
+            self.datatype_suffixes[datatype] = suffix
+        return "\"" + escape_literal(value) + suffix
+
+    def individual(self, subject, statements):
+        # statements is a list of (predicate, object) rendered terms
+        pieces = []
+        for predicate, value in statements:
+            pieces += (subject, "\t", predicate, "\t", value, " .\n")
+        pieces.append("\n")
+        return "".join(pieces)
+
+
+class CompactTurtleSerializer(TurtleSerializer):
+    # Turtle using prefixes derived from the namespaces of the mapping, statements of an individual are grouped
+    # with ";" and consecutive values of a same predicate with ",".
+
+    def __init__(self, mapping, extra_namespaces=None):
+        super().__init__()
+        self.prefixes = {XSD_NAMESPACE: "xsd"}
+        for ori in collect_mapping_oris(mapping) + list(extra_namespaces or []):
+            namespace = split_namespace(ori)[0]
+            if namespace and namespace not in self.prefixes:
+                self.prefixes[namespace] = "ns{}".format(len(self.prefixes) - 1)
+        self.prefix_header = "".join("@prefix {}: <{}> .\n".format(prefix, namespace)
+                                     for namespace, prefix in self.prefixes.items()) + "\n"
+
+    def header(self):
+        return self.prefix_header
+
+    def render_iri(self, ori):
+        ori = str(ori)
+        namespace, local_name = split_namespace(ori)
+        prefix = self.prefixes.get(namespace)
+        if prefix is not None and SAFE_LOCAL_NAME_REGEX.match(local_name):
+            return prefix + ":" + local_name
+        return "<" + ori + ">"
+
+    def generated_iri(self, static, value):
+        return self.render_iri(static + str(value))
+
+    def individual(self, subject, statements):
+        if not statements:
+            return ""
+        pieces = [subject]
+        previous_predicate = None
+        for predicate, value in statements:
+            if predicate == previous_predicate:
+                pieces += (" ,\n        ", value)
+            else:
+                if previous_predicate is not None:
+                    pieces.append(" ;\n")
+                pieces += ("    " if previous_predicate is not None else " ", predicate, " ", value)
+                previous_predicate = predicate
+        pieces.append(" .\n\n")
+        return "".join(pieces)
+
+
+class NTriplesSerializer(TurtleSerializer):
+    # Plain n-triples, rendered directly as utf-8 bytes. N-Triples being a subset of turtle, the output can be sent
+    # to the turtle endpoints.
+    TYPE_PREDICATE = "<" + RDF_TYPE_ORI + ">"
+
+    def header(self):
+        return b""
+
+    def document(self, chunks):
+        return b"".join(chunks)
+
+    def datatype_suffix(self, datatype):
+        return "\"^^<" + XSD_NAMESPACE + datatype + ">"
+
+    def individual(self, subject, statements):
+        pieces = []
+        for predicate, value in statements:
+            pieces += (subject, " ", predicate, " ", value, " .\n")
+        return "".join(pieces).encode('utf-8')
+
+
+def split_namespace(ori):
+    # The namespace of an IRI ends with its last "#" or "/"
+    index = max(ori.rfind("#"), ori.rfind("/"))
+    return ori[:index + 1], ori[index + 1:]
+
+
+def collect_mapping_oris(mapping):
+    # IRIs declared by a mapping : classes, predicates, static parts of generated ids and mapped individuals
+    oris = []
+    for mapping_id, mapping_data in mapping.items():
+        if mapping_id in ("skeleton", "_mapping_id") or type(mapping_data) is not dict:
+            continue
+
+        static = mapping_data.get("_id", {}).get("static")
+        if static:
+            oris.append(static)
+
+        class_metadata = mapping_data.get("_class", {})
+        if class_metadata.get("field_dependent"):
+            oris += collect_map_oris(class_metadata)
+        elif class_metadata.get("value"):
+            oris.append(class_metadata["value"])
+
+        for object_property_metadata in mapping_data.get("_object_properties", []):
+            oris.append(object_property_metadata["object_property_ori"])
+            oris += collect_map_oris(object_property_metadata)
+
+        for key, metadata in mapping_data.items():
+            if type(metadata) is dict and "datatype_property_ori" in metadata:
+                oris.append(metadata["datatype_property_ori"])
+        for metadata in mapping_data.get("_hidden_values", {}).values():
+            oris.append(metadata["datatype_property_ori"])
+    return oris
+
+
+def collect_map_oris(metadata):
+    # Map entries and defaults are either an IRI or a list of IRIs
+    oris = []
+    for targets in list(metadata.get("map", {}).values()) + [metadata.get("default")]:
+        if type(targets) is str:
+            oris.append(targets)
+        elif type(targets) is list:
+            oris += [target for target in targets if type(target) is str]
+    return oris
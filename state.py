@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger()
+
+
+class SingletonState:
+    # Shared control surface of the injector, every method may be called from any thread (workers, operator thread
+    # or the local control endpoint).
+    IDLE = 'IDLE'
+    RUNNING = 'RUNNING'
+    PAUSE = 'PAUSE'
+    STOP = 'STOP'
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = self.IDLE
+
+        self._total_objects = 0
+        self._injected_objects = 0
+        self._in_flight_batches = 0
+        self._started_at = None
+        self._finished_at = None
+        self._paused_at = None
+        self._paused_duration = 0.0
+
+    def get_state(self):
+        with self._condition:
+            return self._state
+
+    def set_state(self, state):
+        with self._condition:
+            if state not in (self.IDLE, self.RUNNING, self.PAUSE, self.STOP):
+                raise Exception("Unknown injector state : {}".format(state))
+
+            now = time.monotonic()
+            # Keep track of the time spent in pause so the throughput only accounts for running time
+            if self._state == self.PAUSE and state != self.PAUSE and self._paused_at is not None:
+                self._paused_duration += now - self._paused_at
+                self._paused_at = None
+            elif state == self.PAUSE and self._state != self.PAUSE:
+                self._paused_at = now
+
+            logger.info("Injector state changed from {} to {}".format(self._state, state))
+            self._state = state
+            self._condition.notify_all()
+
+    def start(self):
+        self.set_state(self.RUNNING)
+
+    def pause(self):
+        self.set_state(self.PAUSE)
+
+    def resume(self):
+        self.set_state(self.RUNNING)
+
+    def stop(self):
+        self.set_state(self.STOP)
+
+    def is_stopped(self):
+        return self.get_state() == self.STOP
+
+    def wait_while_paused(self, timeout=None):
+        # Block the calling worker as long as the injector is paused.
+        # Return False if the injector has been stopped, True otherwise.
+        with self._condition:
+            self._condition.wait_for(lambda: self._state != self.PAUSE, timeout=timeout)
+            return self._state != self.STOP
+
+    def begin_run(self, total_objects):
+        # Reset the progress counters for a new injection. An operator may have already paused the injector before
+        # it started, the run then begins paused. A stop only applies to the run it was issued for, a new run
+        # always starts again.
+        with self._condition:
+            self._total_objects = total_objects
+            self._injected_objects = 0
+            self._in_flight_batches = 0
+            self._started_at = time.monotonic()
+            self._finished_at = None
+            self._paused_duration = 0.0
+            self._paused_at = self._started_at if self._state == self.PAUSE else None
+        if self.get_state() in (self.IDLE, self.STOP):
+            self.start()
+
+    def end_run(self):
+        # Back to IDLE once the run is over, whether it has completed or has been stopped. The progress of the run
+        # stays frozen at its finish time.
+        with self._condition:
+            self._finished_at = time.monotonic()
+            if self._state in (self.RUNNING, self.STOP):
+                self._state = self.IDLE
+                self._condition.notify_all()
+
+    def add_total_objects(self, nb_objects):
+        # The number of objects of a run may only be known once its payloads are converted
+        with self._condition:
+            self._total_objects += nb_objects
+
+    def batch_started(self):
+        with self._condition:
+            self._in_flight_batches += 1
+
+    def batch_done(self, nb_objects):
+        with self._condition:
+            self._in_flight_batches -= 1
+            self._injected_objects += nb_objects
+
+    def batch_aborted(self):
+        with self._condition:
+            self._in_flight_batches -= 1
+
+    def get_progress(self):
+        with self._condition:
+            elapsed = 0.0
+            if self._started_at is not None:
+                now = self._finished_at if self._finished_at is not None else time.monotonic()
+                paused = self._paused_duration
+                if self._paused_at is not None:
+                    paused += max(now - self._paused_at, 0.0)
+                elapsed = max(now - self._started_at - paused, 0.0)
+
+            throughput = self._injected_objects / elapsed if elapsed > 0 else 0.0
+            remaining = max(self._total_objects - self._injected_objects, 0)
+            eta = remaining / throughput if throughput > 0 else None
+
+            return {"state": self._state,
+                    "total_objects": self._total_objects,
+                    "injected_objects": self._injected_objects,
+                    "in_flight_batches": self._in_flight_batches,
+                    "elapsed_seconds": elapsed,
+                    "throughput": throughput,
+                    "eta_seconds": eta}
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    # GET /progress returns the injector progress, POST /start, /pause, /resume and /stop drive the injector.
+    ACTIONS = {"/start": SingletonState.start,
+               "/pause": SingletonState.pause,
+               "/resume": SingletonState.resume,
+               "/stop": SingletonState.stop}
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("", "/progress"):
+            self.send_json(200, SingletonState.instance().get_progress())
+        else:
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        action = self.ACTIONS.get(self.path.rstrip("/"))
+        if action is None:
+            self.send_json(404, {"error": "Unknown action {}".format(self.path)})
+            return
+        state = SingletonState.instance()
+        action(state)
+        self.send_json(200, state.get_progress())
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Control endpoint - " + format % args)
+
+
+def serve_control(host="127.0.0.1", port=8765):
+    # Start the local control endpoint in a daemon thread, call shutdown() on the returned server to stop it.
+    server = ThreadingHTTPServer((host, port), ControlRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="injector-control", daemon=True)
+    thread.start()
+    logger.info("Injector control endpoint listening on http://{}:{}/".format(host, server.server_port))
+    return server
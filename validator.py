@@ -0,0 +1,95 @@
+import re
+
+# Lightweight turtle checker, it only covers the subset of turtle generated by the converter (no blank nodes,
+# collections or multi-line literals) but is fast enough to run on every individual before sending it.
+TOKEN_REGEX = re.compile(r'''
+    (?P<ws>[ \t\r\n]+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\x00-\x20]*>)
+  | (?P<literal>"(?:[^"\\\n\r]|\\[tbnrf"'\\])*"(?:\^\^(?:<[^<>"{}|^`\\\x00-\x20]*>|[A-Za-z][\w.-]*:[\w.-]*)|@[A-Za-z]+(?:-[A-Za-z0-9]+)*)?)
+  | (?P<number>[+-]?(?:\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?))
+  | (?P<keyword>a|true|false)(?![\w:])
+  | (?P<pname>(?:[A-Za-z][\w.-]*)?:[\w.-]*)
+  | (?P<directive>@prefix)
+  | (?P<punctuation>[.;,])
+''', re.VERBOSE)
+
+SUBJECT = "subject"
+PREDICATE = "predicate"
+OBJECT = "object"
+AFTER_OBJECT = "after_object"
+PREFIX_NAME = "prefix_name"
+PREFIX_IRI = "prefix_iri"
+PREFIX_END = "prefix_end"
+
+
+def validate_turtle(ttl):
+    # Return the first error found in the given turtle, None means the turtle is valid
+    expected = SUBJECT
+    position = 0
+    length = len(ttl)
+
+    while position < length:
+        match = TOKEN_REGEX.match(ttl, position)
+        if match is None:
+            return "Unexpected character {!r} at line {}".format(ttl[position], line_of(ttl, position))
+
+        kind = match.lastgroup
+        token = match.group()
+        position = match.end()
+
+        if kind == "ws":
+            continue
+
+        if expected == SUBJECT:
+            if kind == "directive":
+                expected = PREFIX_NAME
+            elif kind in ("iri", "pname"):
+                expected = PREDICATE
+            else:
+                return unexpected(token, "a subject", ttl, match.start())
+        elif expected == PREDICATE:
+            if kind in ("iri", "pname") or token == "a":
+                expected = OBJECT
+            else:
+                return unexpected(token, "a predicate", ttl, match.start())
+        elif expected == OBJECT:
+            if kind in ("iri", "pname", "literal", "number") or token in ("true", "false"):
+                expected = AFTER_OBJECT
+            else:
+                return unexpected(token, "an object", ttl, match.start())
+        elif expected == AFTER_OBJECT:
+            if token == ".":
+                expected = SUBJECT
+            elif token == ";":
+                expected = PREDICATE
+            elif token == ",":
+                expected = OBJECT
+            else:
+                return unexpected(token, "'.', ';' or ','", ttl, match.start())
+        elif expected == PREFIX_NAME:
+            if kind == "pname" and token.endswith(":"):
+                expected = PREFIX_IRI
+            else:
+                return unexpected(token, "a prefix name", ttl, match.start())
+        elif expected == PREFIX_IRI:
+            if kind == "iri":
+                expected = PREFIX_END
+            else:
+                return unexpected(token, "a prefix IRI", ttl, match.start())
+        elif expected == PREFIX_END:
+            if token == ".":
+                expected = SUBJECT
+            else:
+                return unexpected(token, "'.'", ttl, match.start())
+
+    if expected != SUBJECT:
+        return "Unterminated statement at line {}".format(line_of(ttl, length))
+    return None
+
+
+def unexpected(token, expected, ttl, position):
+    return "Unexpected token {!r} at line {}, expected {}".format(token, line_of(ttl, position), expected)
+
+
+def line_of(ttl, position):
+    return ttl.count("\n", 0, position) + 1
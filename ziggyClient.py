@@ -1,10 +1,192 @@
+import asyncio
 import os
+import threading
+import time
 import requests
 import json
 import logging
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 
+# Status codes meaning the server is overloaded, the request content is not at fault
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+
+
+def encode_body(data):
+    # Serializers may already render their output as bytes
+    if isinstance(data, bytes):
+        return data
+    return str(data).encode('utf-8')
+
+
+def count_triples(data):
+    # Cheap estimation of the number of triples held by a turtle payload, every statement ends with " ." and
+    # grouped statements are separated by " ;" or " ,".
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data.count(b" .\n") + data.count(b" ;\n") + data.count(b" ,\n") - data.count(b"@prefix")
+
+
+class TokenBucket:
+    # Thread-safe token bucket, tokens may be borrowed so a request bigger than the capacity is delayed
+    # instead of being blocked forever.
+
+    def __init__(self, rate, capacity=None):
+        self._lock = threading.Lock()
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1.0))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, amount=1):
+        # Take the tokens and return the delay to wait before they are actually available
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, amount=1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, amount=1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    # Rate limiter of a namespace, shared by every client and worker injecting into it.
+    # The effective rates follow an AIMD scheme driven by the server responses : they are halved when the server
+    # answers slowly or is overloaded, and slowly increased back to the configured maximum otherwise.
+    _namespaces = dict()
+    _namespaces_lock = threading.Lock()
+
+    @classmethod
+    def for_namespace(cls, namespace, **kwargs):
+        with cls._namespaces_lock:
+            limiter = cls._namespaces.get(namespace)
+            if limiter is None:
+                limiter = cls(**kwargs)
+                cls._namespaces[namespace] = limiter
+            else:
+                limiter.configure(**kwargs)
+            return limiter
+
+    def __init__(self, requests_per_second=None, triples_per_second=None, target_latency=None,
+                 write_target_latency=None, min_ratio=None, increase_step=None):
+        self._lock = threading.Lock()
+        self.requests_per_second = None
+        self.triples_per_second = None
+        self.requests_bucket = None
+        self.triples_bucket = None
+        # Latencies above which the server is considered overloaded, batch writes are expected to be much slower
+        # than finds.
+        self.target_latency = 5.0
+        self.write_target_latency = 60.0
+        self.min_ratio = 0.05
+        self.increase_step = 0.05
+        self.ratio = 1.0
+        self._last_decrease_at = 0.0
+        # Latency window following the last decrease, responses received within it do not reflect the new rate
+        self._decrease_window = 0.0
+        self._last_increase_at = 0.0
+        # Last verdict of the reads and of the writes, the rate is only increased back when neither is overloaded
+        self._overloaded = {False: False, True: False}
+        self.configure(requests_per_second, triples_per_second, target_latency, write_target_latency, min_ratio,
+                       increase_step)
+
+    def configure(self, requests_per_second=None, triples_per_second=None, target_latency=None,
+                  write_target_latency=None, min_ratio=None, increase_step=None):
+        # Only the given values are changed. Existing buckets are kept with their tokens so a new client of the
+        # namespace does not allow a burst.
+        with self._lock:
+            if requests_per_second:
+                self.requests_per_second = requests_per_second
+                if self.requests_bucket is None:
+                    self.requests_bucket = TokenBucket(requests_per_second)
+            if triples_per_second:
+                self.triples_per_second = triples_per_second
+                # Let a whole batch go through at once, the bucket capacity is one second worth of triples
+                if self.triples_bucket is None:
+                    self.triples_bucket = TokenBucket(triples_per_second)
+            if target_latency is not None:
+                self.target_latency = target_latency
+            if write_target_latency is not None:
+                self.write_target_latency = write_target_latency
+            if min_ratio is not None:
+                self.min_ratio = min_ratio
+            if increase_step is not None:
+                self.increase_step = increase_step
+            self._apply_ratio()
+
+    def _apply_ratio(self):
+        if self.requests_bucket is not None:
+            self.requests_bucket.set_rate(self.requests_per_second * self.ratio)
+        if self.triples_bucket is not None:
+            self.triples_bucket.set_rate(self.triples_per_second * self.ratio)
+
+    def reserve(self, triples=0):
+        delay = 0.0
+        if self.requests_bucket is not None:
+            delay = self.requests_bucket.reserve(1)
+        if self.triples_bucket is not None and triples > 0:
+            delay = max(delay, self.triples_bucket.reserve(triples))
+        return delay
+
+    def acquire(self, triples=0):
+        delay = self.reserve(triples)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, triples=0):
+        delay = self.reserve(triples)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def feedback(self, latency, status_code=None, write=False):
+        # status_code is None when no response has been received (connection error, timeout)
+        target_latency = self.write_target_latency if write else self.target_latency
+        overloaded = status_code is None or status_code in OVERLOAD_STATUS_CODES or latency > target_latency
+        with self._lock:
+            now = time.monotonic()
+            self._overloaded[write] = overloaded
+            if overloaded:
+                # Only decrease once per latency window, responses of requests sent before the decrease
+                # do not reflect the new rate.
+                if now - self._last_decrease_at < self._decrease_window:
+                    return
+                self._last_decrease_at = now
+                self._decrease_window = target_latency
+                self.ratio = max(self.min_ratio, self.ratio / 2)
+                logger.warning("Server overloaded (status: {}, latency: {:.2f}s), rate lowered to {:.0%}"
+                               .format(status_code, latency, self.ratio))
+            else:
+                # Increase at most once per latency window, once the window following the last decrease is over
+                # and as long as neither the reads nor the writes are overloaded : fast finds must not undo a
+                # decrease caused by slow writes.
+                if self.ratio >= 1.0 or any(self._overloaded.values()) \
+                        or now - self._last_decrease_at < self._decrease_window \
+                        or now - self._last_increase_at < target_latency:
+                    return
+                self._last_increase_at = now
+                self.ratio = min(1.0, self.ratio + self.increase_step)
+            self._apply_ratio()
+
 
 class ZiggyHTTPClient:
     # Strange behavior using localhost address, translation seems to shortcut the parameters
@@ -20,11 +202,46 @@ class ZiggyHTTPClient:
     PROJECTION_UPDATE_UNSET_ENTRY = "update/unset/"
     PROJECTION_UPDATE_SET_ENTRY = "update/set/"
 
+    # (connect, read) timeouts in seconds, batch writes may take a while to be processed by the server
+    FIND_TIMEOUT = (5, 60)
+    WRITE_TIMEOUT = (5, 300)
+
     # ADMIN_NAMESPACE
 
-    def __init__(self, namespace, endpoint):
+    def __init__(self, namespace, endpoint, requests_per_second=None, triples_per_second=None, rate_limiter=None,
+                 pool_connections=10, pool_maxsize=10, max_retries=0, find_timeout=None, write_timeout=None,
+                 adapter=None, recorder=None, target_latency=None, write_target_latency=None):
         self.namespace = namespace
-        self.session = requests.Session()
+        # Optional replay.TrafficRecorder keeping track of every call and its response
+        self.recorder = recorder
+
+        # Sessions are not thread-safe, each thread gets its own session but they all share the same adapter,
+        # hence the same connection pool. pool_maxsize should be at least the number of injection workers.
+        self.adapter = adapter if adapter is not None else HTTPAdapter(pool_connections=pool_connections,
+                                                                       pool_maxsize=pool_maxsize,
+                                                                       max_retries=max_retries)
+        self.local = threading.local()
+
+        self.find_timeout = find_timeout if find_timeout is not None else self.FIND_TIMEOUT
+        self.write_timeout = write_timeout if write_timeout is not None else self.WRITE_TIMEOUT
+
+        # Header templates, requests never mutates them so they are shared by every call
+        self.turtle_headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
+        self.json_headers = {"namespace": self.namespace, "Content-Type": "application/json",
+                             "Accept": "application/json"}
+        self.find_headers = {value: dict(self.json_headers, **{"Hide-Default-Namespace": value})
+                             for value in ("true", "false")}
+        self.strict_read_headers = {"Namespace": self.namespace, "Content-Type": "text/turtle",
+                                    "read-mode": "strict"}
+        self.namespace_headers = {"namespace": self.namespace}
+
+        # Clients of the same namespace share the same rate limiter, unless one is explicitly given
+        if rate_limiter is None and (requests_per_second or triples_per_second):
+            rate_limiter = RateLimiter.for_namespace(namespace, requests_per_second=requests_per_second,
+                                                     triples_per_second=triples_per_second,
+                                                     target_latency=target_latency,
+                                                     write_target_latency=write_target_latency)
+        self.rate_limiter = rate_limiter
 
         self.endpoint = str(endpoint)
 
@@ -38,170 +255,204 @@ class ZiggyHTTPClient:
 
         logger.info("ZiggyHTTPClient will run with following proxies : {}".format(self.PROXIES))
 
+    @property
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    def get_find_headers(self, hide_default_namespace):
+        headers = self.find_headers.get(hide_default_namespace)
+        if headers is None:
+            headers = dict(self.json_headers, **{"Hide-Default-Namespace": hide_default_namespace})
+        return headers
+
+    def _request(self, method, url, write=False, **kwargs):
+        # Triples are only counted when something makes use of them
+        triples = 0
+        if write and kwargs.get("data") is not None and (self.rate_limiter is not None or self.recorder is not None):
+            triples = count_triples(kwargs["data"])
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(triples)
+
+        begin = time.monotonic()
+        try:
+            response = self.session.request(method, url, proxies=self.PROXIES, **kwargs)
+        except requests.RequestException as e:
+            latency = time.monotonic() - begin
+            if self.rate_limiter is not None:
+                self.rate_limiter.feedback(latency, write=write)
+            if self.recorder is not None:
+                self.recorder.record(self, method, url, kwargs, None, latency, triples, error=e)
+            raise
+        latency = time.monotonic() - begin
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.feedback(latency, response.status_code, write=write)
+        if self.recorder is not None:
+            self.recorder.record(self, method, url, kwargs, response, latency, triples)
+        return response
+
     def get_projection_by_ori(self, ori, hide_default_namespace = "true"):
 
-        headers = {"namespace": self.namespace,
-                   "Content-Type": "application/json",
-                   "Accept": "application/json",
-                   "Hide-Default-Namespace": hide_default_namespace}
+        headers = self.get_find_headers(hide_default_namespace)
         payload = {"query": {"$ori": str(ori)}}
         payload = json.dumps(payload)
 
         logger.info("POST - url : {}, headers : {}".format(self.projection_find_url, headers))
-        logger.debug("POST - url : {}, data : {}, headers : {}".format(self.projection_find_url, payload, headers))
+        logger.debug("POST - url : %s, data : %s, headers : %s", self.projection_find_url, payload, headers)
 
-        return self.session.post(self.projection_find_url, data=payload, proxies=self.PROXIES, headers=headers)
+        return self._request("POST", self.projection_find_url, data=payload, headers=headers, timeout=self.find_timeout)
 
     def get_projections_by_ori(self, oris, size, hide_default_namespace = "true"):
 
-        headers = {"namespace": self.namespace,
-                   "Content-Type": "application/json",
-                   "Accept": "application/json",
-                   "Hide-Default-Namespace": hide_default_namespace}
+        headers = self.get_find_headers(hide_default_namespace)
         payload = {"query": {"$ori": { "$in" : oris}}}
         payload = json.dumps(payload)
 
         logger.info("POST - url : {}, headers : {}".format(self.projection_find_url, headers))
-        logger.debug("POST - url : {}, data : {}, headers : {}".format(self.projection_find_url, payload, headers))
+        logger.debug("POST - url : %s, data : %s, headers : %s", self.projection_find_url, payload, headers)
 
-        return self.session.post(self.projection_find_url + "?size={}".format(size), data=payload, proxies=self.PROXIES, headers=headers)
+        return self._request("POST", self.projection_find_url + "?size={}".format(size), data=payload, headers=headers,
+                             timeout=self.find_timeout)
 
     def get_projection_by_uuid(self, uuid):
 
-        headers = {"Namespace": self.namespace,
-                   "Content-Type": "text/turtle",
-                   "read-mode": "strict"}
+        headers = self.strict_read_headers
         url = self.projection_url + uuid
 
         logger.info("GET - url : {}, headers : {}".format(url, headers))
 
-        return self.session.get(url, proxies=self.PROXIES, headers=headers)
+        return self._request("GET", url, headers=headers, timeout=self.find_timeout)
 
     def create_projection(self, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
 
         logger.info("POST - url : {}, headers : {}".format(self.projection_url, headers))
-        logger.debug("POST - url : {}, data : {}, headers : {}".format(self.projection_url, data, headers))
+        logger.debug("POST - url : %s, data : %s, headers : %s", self.projection_url, data, headers)
 
-        return self.session.post(self.projection_url, data=data, proxies=self.PROXIES, headers=headers,
-                                 allow_redirects=False)
+        return self._request("POST", self.projection_url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def create_projection_batch(self, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
 
         logger.info(
             "POST - url : {}, headers : {}".format(self.batch_projection_url, headers))
-        logger.debug(
-            "POST - url : {}, data : {}, headers : {}".format(self.batch_projection_url, data, headers))
+        logger.debug("POST - url : %s, data : %s, headers : %s", self.batch_projection_url, data, headers)
 
-        return self.session.post(self.batch_projection_url, data=data, proxies=self.PROXIES, headers=headers,
-                                 allow_redirects=False)
+        return self._request("POST", self.batch_projection_url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def delete_projection(self, uuid):
 
-        headers = {"namespace": self.namespace}
+        headers = self.namespace_headers
         url = self.projection_url + uuid
 
         logger.info("DELETE - url : {}, headers : {}".format(url, headers))
 
-        return self.session.delete(url, proxies=self.PROXIES, headers=headers, allow_redirects=False)
+        return self._request("DELETE", url, headers=headers, timeout=self.write_timeout, write=True,
+                             allow_redirects=False)
 
     def delete_projection_batch(self, uuids):
-        headers = {"namespace": self.namespace, "Content-Type": "application/json", "Accept": "application/json"}
+        headers = self.json_headers
         logger.info("DELETE - url : {}, headers : {}".format(self.batch_projection_url, headers))
 
-        return self.session.delete(self.batch_projection_url, json=uuids, proxies=self.PROXIES, headers=headers,
-                                   allow_redirects=False)
+        return self._request("DELETE", self.batch_projection_url, json=uuids, headers=headers,
+                             timeout=self.write_timeout, write=True, allow_redirects=False)
 
     def update_replace_projection(self, uuid, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.projection_url + self.PROJECTION_ENTRY + self.PROJECTION_UPDATE_REPLACE_ENTRY + uuid
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def update_replace_projection_batch(self, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.batch_projection_url + self.PROJECTION_UPDATE_REPLACE_ENTRY
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def update_set_projection(self, uuid, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.endpoint + self.PROJECTION_ENTRY + self.PROJECTION_UPDATE_SET_ENTRY + uuid
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def update_set_projection_batch(self, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.batch_projection_url + self.PROJECTION_UPDATE_SET_ENTRY
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def update_unset_projection(self, uuid, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.projection_url + self.PROJECTION_ENTRY + self.PROJECTION_UPDATE_UNSET_ENTRY + uuid
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def update_unset_projection_batch(self, data):
 
-        headers = {"namespace": self.namespace, "Content-Type": "text/turtle"}
-        data = str(data).encode('utf-8')
+        headers = self.turtle_headers
+        data = encode_body(data)
         url = self.batch_projection_url + self.PROJECTION_UPDATE_UNSET_ENTRY
 
         logger.info("PUT - url : {}, headers : {}".format(url, headers))
-        logger.debug("PUT - url : {}, data : {}, headers : {}".format(url, data, headers))
+        logger.debug("PUT - url : %s, data : %s, headers : %s", url, data, headers)
 
-        return self.session.put(url, data=data, proxies=self.PROXIES, headers=headers,
-                                allow_redirects=False)
+        return self._request("PUT", url, data=data, headers=headers, timeout=self.write_timeout,
+                             write=True, allow_redirects=False)
 
     def get_projections_by_namespace(self, size = 1000, index = 0, hide_default_namespace = "true"):
-        headers = {"namespace": self.namespace, "Content-Type": "application/json", "Accept": "application/json", "Hide-Default-Namespace": hide_default_namespace}
+        headers = self.get_find_headers(hide_default_namespace)
         data = '''{
                  "query": {}
                }'''
         url = self.projection_find_url + "?size={}&index={}".format(size, index)
-        return self.session.post(url, data=data, proxies=self.PROXIES, headers=headers,
-                                 allow_redirects=False)
+        return self._request("POST", url, data=data, headers=headers, timeout=self.find_timeout, allow_redirects=False)
 
 
     def get_projections_by_classes(self, classes, size = 1000, index = 0, hide_default_namespace = "true"):
-        headers = {"namespace": self.namespace, "Content-Type": "application/json", "Accept": "application/json", "Hide-Default-Namespace": hide_default_namespace}
+        headers = self.get_find_headers(hide_default_namespace)
         data = {"query": {"$class": { "$in" : classes}}}
         url = self.projection_find_url + "?size={}&index={}".format(size, index)
-        return self.session.post(url, json=data, proxies=self.PROXIES, headers=headers,
-                                 allow_redirects=False)
\ No newline at end of file
+        return self._request("POST", url, json=data, headers=headers, timeout=self.find_timeout, allow_redirects=False)
\ No newline at end of file